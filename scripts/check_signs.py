@@ -15,10 +15,13 @@
 # Date: 2025-07-31
 # Version: 2.2
 
-import geopandas as gpd
+import csv
+import numpy as np
 import pandas as pd
 import os
 import pyogrio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Configuration ---
 # Get the directory where the script is located.
@@ -29,6 +32,46 @@ PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 GEOPACKAGE_PATH = os.path.join(PROJECT_ROOT, "cuesta-trees", "cuesta-trees.gpkg")
 # Define the output CSV name, which will be saved in the same directory as the script.
 OUTPUT_CSV_NAME = os.path.join(SCRIPT_DIR, "new_sign_orders.csv")
+# Reports with more rows than this are streamed to disk by pandas in chunks.
+CSV_CHUNK_THRESHOLD = 10_000
+CSV_CHUNK_SIZE = 5_000
+# Output files are written through a 4 MiB buffer to cut down on write syscalls.
+CSV_BUFFER_SIZE = 4 * 1024 * 1024
+# The note recorded for each compared column ('scientific_name', 'common_name', 'family').
+MISMATCH_REASONS = ["Scientific name mismatch.", "Common name mismatch.", "Family mismatch."]
+# The note for every combination of mismatches, indexed by a bitmask in which
+# bit i is set when the i-th compared column differs.
+REASON_TABLE = np.array([
+    " ".join(reason for i, reason in enumerate(MISMATCH_REASONS) if code & (1 << i))
+    for code in range(1 << len(MISMATCH_REASONS))
+])
+
+def normalize_names(values: pd.Series) -> np.ndarray:
+    """
+    Normalizes a column of names for comparison: missing values become empty
+    strings, and the rest are stripped of whitespace and lower-cased. Names
+    repeat across many trees, so each distinct value is normalized only once
+    and the results are gathered back into place.
+    """
+    codes, uniques = pd.factorize(values.fillna(''))
+    normalized = np.char.lower(np.char.strip(np.asarray(uniques, dtype=str)))
+    return normalized[codes]
+
+def write_csv(df: pd.DataFrame, path: str):
+    """
+    Writes a DataFrame to a CSV file without its index, through a large write
+    buffer. Small reports are written directly with csv.writer; large ones are
+    written by pandas in chunks to cap memory use.
+    """
+    with open(path, 'w', newline='', buffering=CSV_BUFFER_SIZE) as f:
+        if len(df) > CSV_CHUNK_THRESHOLD:
+            df.to_csv(f, index=False, chunksize=CSV_CHUNK_SIZE)
+            return
+
+        # Match pandas' output: native line endings and empty fields for missing values.
+        writer = csv.writer(f, lineterminator=os.linesep)
+        writer.writerow(df.columns)
+        writer.writerows(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
 
 def check_and_correct_signs():
     """
@@ -38,10 +81,27 @@ def check_and_correct_signs():
     # --- 1. Load Data ---
     print(f"Loading data from '{GEOPACKAGE_PATH}'...")
     try:
-        # read_file returns a DataFrame if the table has no geometry.
-        signs_df = gpd.read_file(GEOPACKAGE_PATH, layer='sign_inventory_current')
+        # Neither table has geometry, so skip decoding it and load only the
+        # columns used for the comparison. The two reads are independent and
+        # run in GDAL's native code, so they are done concurrently.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            signs_future = executor.submit(
+                pyogrio.read_dataframe,
+                GEOPACKAGE_PATH,
+                layer='sign_inventory_current',
+                columns=['tree_id', 'sign_scientific_name', 'sign_common_name', 'sign_family'],
+                read_geometry=False
+            )
+            master_future = executor.submit(
+                pyogrio.read_dataframe,
+                GEOPACKAGE_PATH,
+                layer='species_master_current',
+                columns=['tree_id', 'scientific_name', 'common_name', 'family', 'origin'],
+                read_geometry=False
+            )
+            signs_df = signs_future.result()
+            master_gdf = master_future.result()
         print(f"Loaded {len(signs_df)} records from 'sign_inventory_current'.")
-        master_gdf = gpd.read_file(GEOPACKAGE_PATH, layer='species_master_current')
         print(f"Loaded {len(master_gdf)} records from 'species_master_current'.")
     except Exception as e:
         print(f"Error: Could not read the required tables from the geopackage. Details: {e}")
@@ -62,95 +122,102 @@ def check_and_correct_signs():
             print(f"Error: Column '{col}' not found in 'species_master_current'.")
             return
 
-    signs_to_check = signs_df[sign_cols_prefixed].copy()
-    signs_to_check.columns = ['tree_id'] + comparison_cols
+    # Each tree must map to a single master record.
+    if not master_gdf['tree_id'].is_unique:
+        print("Error: Duplicate 'tree_id' values found in 'species_master_current'.")
+        return
 
     # --- 3. Find Discrepancies ---
-    # Merge on tree_id to get the correct master information for each tree
-    merged_df = pd.merge(
-        signs_to_check,
-        master_gdf[['tree_id'] + master_cols],
-        on='tree_id',
-        how='left',
-        suffixes=('_sign', '_master')
-    )
-
-    discrepancies = []
-    for _, row in merged_df.iterrows():
-        mismatch_reasons = []
-        
-        # Check if tree_id exists in master list
-        if pd.isna(row['scientific_name_master']):
-            mismatch_reasons.append("Tree ID not found in master list.")
-        else:
-            # Compare sign data with master data
-            if str(row['scientific_name_sign']).strip().lower() != str(row['scientific_name_master']).strip().lower():
-                mismatch_reasons.append("Scientific name mismatch.")
-            if str(row['common_name_sign']).strip().lower() != str(row['common_name_master']).strip().lower():
-                mismatch_reasons.append("Common name mismatch.")
-            if str(row['family_sign']).strip().lower() != str(row['family_master']).strip().lower():
-                mismatch_reasons.append("Family mismatch.")
-
-        if mismatch_reasons:
-            # Always use master data when available, otherwise indicate missing
-            if pd.isna(row['scientific_name_master']):
-                discrepancies.append({
-                    "tree_id": row['tree_id'],
-                    "note": " ".join(mismatch_reasons),
-                    "scientific_name": "Missing from master list",
-                    "common_name": "Missing from master list",
-                    "family": "Missing from master list",
-                    "origin": "Missing from master list"
-                })
-            else:
-                discrepancies.append({
-                    "tree_id": row['tree_id'],
-                    "note": " ".join(mismatch_reasons),
-                    "scientific_name": row['scientific_name_master'],
-                    "common_name": row['common_name_master'],
-                    "family": row['family_master'],
-                    "origin": row['origin']
-                })
+    # Look up the correct master information for each tree by tree_id
+    signs_to_check = signs_df[sign_cols_prefixed].copy()
+    master_by_id = master_gdf.set_index('tree_id')
+    for col in master_cols:
+        signs_to_check[f'master_{col}'] = signs_to_check['tree_id'].map(master_by_id[col])
+
+    # Trees without a master record have no master scientific name.
+    missing = signs_to_check['master_scientific_name'].isna().to_numpy()
+
+    # Many trees share the same sign text and master entry, so each distinct
+    # pairing is compared once and the result is broadcast back to its trees.
+    pair_cols = [f'sign_{col}' for col in comparison_cols] + [f'master_{col}' for col in comparison_cols]
+    pair_ids = signs_to_check.groupby(pair_cols, dropna=False, sort=False).ngroup()
+    unique_pairs = signs_to_check.loc[pair_ids.drop_duplicates().index]
+
+    # Compare sign data with master data, with both sides normalized first.
+    pair_mismatches = np.empty((len(unique_pairs), len(comparison_cols)), dtype=bool)
+    for i, col in enumerate(comparison_cols):
+        sign_values = normalize_names(unique_pairs[f'sign_{col}'])
+        master_values = normalize_names(unique_pairs[f'master_{col}'])
+        pair_mismatches[:, i] = sign_values != master_values
+    mismatches = pair_mismatches[pair_ids.to_numpy()] & ~missing[:, np.newaxis]
+
+    # Pack each row's mismatches into a bitmask and look its note up in the table.
+    bits = mismatches.astype(np.uint8) << np.arange(len(comparison_cols), dtype=np.uint8)
+    reason_codes = np.bitwise_or.reduce(bits, axis=1)
+    notes = np.where(missing, "Tree ID not found in master list.", REASON_TABLE[reason_codes])
+
+    has_issue = missing | (reason_codes != 0)
+
+    # Always use master data when available, otherwise indicate missing.
+    # The mapped columns are float when the master table is empty or a column is
+    # all null, so they are cast to object before the text is filled in.
+    master_out_cols = [f'master_{col}' for col in master_cols]
+    signs_to_check[master_out_cols] = signs_to_check[master_out_cols].astype(object)
+    signs_to_check.loc[missing, master_out_cols] = "Missing from master list"
+    discrepancies_df = pd.DataFrame({
+        "tree_id": signs_to_check['tree_id'],
+        "note": notes,
+        "scientific_name": signs_to_check['master_scientific_name'],
+        "common_name": signs_to_check['master_common_name'],
+        "family": signs_to_check['master_family'],
+        "origin": signs_to_check['master_origin'],
+    })[has_issue]
 
     # --- 4. Process Discrepancies ---
-    if not discrepancies:
+    if discrepancies_df.empty:
         print("\nNo discrepancies found. All signs are consistent with the master list.")
         return
 
-    print(f"\nFound {len(discrepancies)} signs with issues.")
-    discrepancies_df = pd.DataFrame(discrepancies)
+    print(f"\nFound {len(discrepancies_df)} signs with issues.")
 
     # --- 5. Generate New Sign Order CSV ---
     print(f"Generating new sign order list at '{OUTPUT_CSV_NAME}'...")
     order_list_df = discrepancies_df[['tree_id', 'scientific_name', 'common_name', 'family', 'origin', 'note']]
-    order_list_df.to_csv(OUTPUT_CSV_NAME, index=False)
+    write_csv(order_list_df, OUTPUT_CSV_NAME)
     print("Sign order list generated successfully.")
 
     # --- 6. Update Geopackage ---
     print("Updating 'sign_inventory_current' in the geopackage...")
-    update_count = 0
-    for _, discrepancy in discrepancies_df.iterrows():
-        tree_id_to_update = discrepancy['tree_id']
-        target_row_idx = signs_df.index[signs_df['tree_id'] == tree_id_to_update]
-        
-        if not target_row_idx.empty:
-            signs_df.loc[target_row_idx, 'sign_status'] = "Sign Issue"
-            signs_df.loc[target_row_idx, 'sign_notes'] = discrepancy['note']
-            update_count += 1
+    # Only the flagged rows are updated in place; the rest of the layer is left untouched.
+    updates = [
+        ("Sign Issue", note, tree_id)
+        for tree_id, note in zip(discrepancies_df['tree_id'].tolist(), discrepancies_df['note'].tolist())
+    ]
+    try:
+        con = sqlite3.connect(GEOPACKAGE_PATH)
+        try:
+            # The connection context manager wraps the batch in a single transaction.
+            with con:
+                con.executemany(
+                    "UPDATE sign_inventory_current SET sign_status = ?, sign_notes = ? WHERE tree_id = ?",
+                    updates
+                )
+        finally:
+            con.close()
+    except Exception as e:
+        print(f"Error: Failed to write updates to the geopackage. Details: {e}")
+        return
+
+    # Each flagged sign counts as one update, even if its tree_id appears on more
+    # than one row of the layer.
+    update_count = len(updates)
 
     if update_count > 0:
-        try:
-            print(f"Saving {update_count} updates back to the geopackage...")
-            # Use pyogrio.write_dataframe to write the pandas DataFrame to the geopackage layer.
-            # This correctly handles non-spatial tables.
-            pyogrio.write_dataframe(signs_df, GEOPACKAGE_PATH, layer='sign_inventory_current', driver='GPKG')
-            print("Geopackage updated successfully.")
-        except Exception as e:
-            print(f"Error: Failed to write updates to the geopackage. Details: {e}")
+        print(f"Saved {update_count} updates back to the geopackage.")
+        print("Geopackage updated successfully.")
     else:
         print("No records needed updating in the geopackage.")
 
-
 if __name__ == "__main__":
     # --- Script Execution ---
     if not os.path.exists(GEOPACKAGE_PATH):
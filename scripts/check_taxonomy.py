@@ -10,27 +10,133 @@
 # Date: 2024-07-31
 # Version: 5.0
 
-import geopandas as gpd
+import orjson
 import pandas as pd
+import pyogrio
 import requests
 import argparse
+import importlib.util
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
 from tqdm import tqdm
-import time
+from urllib3.util.retry import Retry
 
 # --- Configuration ---
+# Get the directory where the script is located.
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 # The base URL for the GBIF species API.
 GBIF_API_URL = "https://api.gbif.org/v1/species"
+# The columns read from the species table.
+SPECIES_COLUMNS = ["scientific_name", "family", "common_name"]
 # The name of the output file for discrepancies.
 OUTPUT_CSV_NAME = "taxonomic_discrepancies.csv"
+# The output file is written through a 4 MiB buffer to cut down on write syscalls.
+CSV_BUFFER_SIZE = 4 * 1024 * 1024
+# Names are compared as Arrow-backed strings when pyarrow is installed, so the
+# vectorized str methods run without Python objects; otherwise plain str is used.
+NAME_DTYPE = "string[pyarrow]" if importlib.util.find_spec("pyarrow") else str
+# The default number of concurrent requests made to the GBIF API.
+MAX_WORKERS = 16
+# GBIF responses are cached on disk so re-runs don't repeat the same lookups.
+CACHE_PATH = os.path.join(SCRIPT_DIR, "gbif_cache.sqlite")
+CACHE_EXPIRY = timedelta(days=30)
+# Taxon details fetched by usage key change far less often than name matches.
+TAXON_CACHE_EXPIRY = timedelta(days=90)
+# Identify the script to GBIF and ask for JSON responses.
+HTTP_HEADERS = {"User-Agent": "cuesta-trees-taxonomy-check/5.0", "Accept": "application/json"}
 
-def get_best_gbif_match(scientific_name: str) -> dict | None:
+# Taxa fetched by usage key, shared by every worker thread for the rest of the run.
+_taxon_cache: dict[int, dict] = {}
+# One lock per usage key, so threads resolving the same taxon wait on a single fetch.
+_taxon_locks: dict[int, threading.Lock] = {}
+_taxon_locks_guard = threading.Lock()
+
+def create_session(pool_size: int = MAX_WORKERS) -> requests.Session:
+    """
+    Creates an HTTP session for the GBIF API. Successful responses are cached
+    on disk, a bounded pool of connections is kept alive between requests, and
+    rate-limited or failed (HTTP 429/5xx) responses are retried with an
+    exponential backoff.
+
+    Args:
+        pool_size: The maximum number of connections (and so of concurrent
+            requests) to keep open to GBIF.
+
+    Returns:
+        A configured requests.Session.
+    """
+    # Only back off when GBIF is throttling (429) or struggling (5xx), honouring
+    # any Retry-After header it sends.
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True
+    )
+    # Blocking on a full pool keeps every request on one of pool_size warm
+    # connections instead of opening (and handshaking) throwaway ones, and caps
+    # the number of requests in flight to GBIF.
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        pool_block=True,
+        max_retries=retry
+    )
+    # URL patterns are matched in order and without the scheme. Expired entries
+    # that carry an ETag or Last-Modified header are revalidated with a
+    # conditional request, so unchanged responses come back as a bodiless 304;
+    # if GBIF errors instead, the stale copy is used.
+    gbif_url_pattern = GBIF_API_URL.split("://", 1)[-1]
+    session = CachedSession(
+        CACHE_PATH,
+        expire_after=CACHE_EXPIRY,
+        urls_expire_after={
+            f"{gbif_url_pattern}/match": CACHE_EXPIRY,
+            f"{gbif_url_pattern}/*": TAXON_CACHE_EXPIRY
+        },
+        allowable_codes=(200,),
+        stale_if_error=True
+    )
+    session.headers.update(HTTP_HEADERS)
+    session.mount("https://", adapter)
+    return session
+
+def get_gbif_taxon(session: requests.Session, usage_key: int) -> dict:
+    """
+    Fetches a taxon's details from the GBIF API by its usage key. Several
+    synonyms often resolve to the same accepted taxon, so results are
+    memoized by usage key for the rest of the run, and concurrent lookups of
+    the same key share one request.
+
+    Args:
+        session: The HTTP session used to query the API.
+        usage_key: The GBIF usage key of the taxon.
+
+    Returns:
+        A dictionary containing the taxon data from GBIF. Request and decoding
+        errors are raised to the caller and not memoized.
+    """
+    with _taxon_locks_guard:
+        lock = _taxon_locks.setdefault(usage_key, threading.Lock())
+    with lock:
+        if usage_key not in _taxon_cache:
+            response = session.get(f"{GBIF_API_URL}/{usage_key}", timeout=30)
+            response.raise_for_status()
+            _taxon_cache[usage_key] = orjson.loads(response.content)
+        return _taxon_cache[usage_key]
+
+def get_best_gbif_match(session: requests.Session, scientific_name: str) -> dict | None:
     """
     Queries the GBIF API for a given scientific name and returns the best
     ACCEPTED taxonomic match. If the name is a synonym, it resolves to the
     accepted name.
 
     Args:
+        session: The HTTP session used to query the API.
         scientific_name: The scientific name of the species to look up.
 
     Returns:
@@ -44,11 +150,9 @@ def get_best_gbif_match(scientific_name: str) -> dict | None:
     match_url = f"{GBIF_API_URL}/match"
     params = {"name": scientific_name, "strict": "false", "verbose": "true"}
     try:
-        # A short delay to be respectful to the API
-        time.sleep(0.05)
-        response = requests.get(match_url, params=params, timeout=30)
+        response = session.get(match_url, params=params, timeout=30)
         response.raise_for_status()  # Raises an HTTPError for bad responses
-        match_data = response.json()
+        match_data = orjson.loads(response.content)
 
         # If GBIF returns no match, we stop here.
         if match_data.get("matchType") == "NONE":
@@ -62,17 +166,23 @@ def get_best_gbif_match(scientific_name: str) -> dict | None:
             return match_data
 
         elif status == "SYNONYM":
-            # The name is a synonym. We must fetch the accepted taxon's details.
+            # The name is a synonym, so we need the accepted taxon's details.
             accepted_key = match_data.get("speciesKey") # Key for the accepted name
             if not accepted_key:
                 return None # Should not happen, but good to be safe
 
-            accepted_taxon_url = f"{GBIF_API_URL}/{accepted_key}"
-            time.sleep(0.05) # Another small delay for the second API call
-            accepted_response = requests.get(accepted_taxon_url, timeout=30)
-            accepted_response.raise_for_status()
-            accepted_data = accepted_response.json()
-            
+            if match_data.get("species") and match_data.get("family"):
+                # The match's classification already describes the accepted species,
+                # which saves a second round trip.
+                accepted_data = {
+                    "key": accepted_key,
+                    "canonicalName": match_data["species"],
+                    "family": match_data["family"]
+                }
+            else:
+                # Copy the memoized taxon so the fields added below don't leak into it.
+                accepted_data = dict(get_gbif_taxon(session, accepted_key))
+
             # Persist the original confidence and match type for context in the report
             accepted_data['confidence'] = match_data.get('confidence')
             accepted_data['matchType'] = match_data.get('matchType')
@@ -82,79 +192,134 @@ def get_best_gbif_match(scientific_name: str) -> dict | None:
             # The status is DOUBTFUL, PROPARTE, etc. We treat these as no valid match.
             return None
 
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         print(f"\nAPI request failed for '{scientific_name}': {e}")
         return None
 
-def check_taxonomy(geopackage_path: str, table_name: str):
+def names_differ(original: pd.Series, gbif: pd.Series) -> pd.Series:
+    """
+    Compares two columns of names. Comparisons are case-insensitive and
+    stripped of whitespace for robustness; rows where either name is missing
+    are not counted as differing.
+
+    Args:
+        original: The names from the species table.
+        gbif: The corresponding names from GBIF.
+
+    Returns:
+        A boolean Series that is True where both names are present and differ.
+    """
+    original = original.fillna("").astype(NAME_DTYPE)
+    gbif = gbif.fillna("").astype(NAME_DTYPE)
+    differ = original.str.strip().str.lower() != gbif.str.strip().str.lower()
+    return differ & (original != "") & (gbif != "")
+
+def fetch_gbif_matches(session: requests.Session, lookup_names: dict[str, str], max_workers: int) -> dict:
+    """
+    Looks up every name against GBIF in a single pre-pass, so the comparison
+    that follows only needs in-memory dictionary lookups. The API calls are
+    I/O-bound, so several are kept in flight at once.
+
+    Args:
+        session: The HTTP session used to query the API.
+        lookup_names: A dictionary mapping each lookup key to the scientific name to query.
+        max_workers: The number of GBIF requests to keep in flight at once.
+
+    Returns:
+        A dictionary mapping each lookup key to its best accepted GBIF match,
+        or None where no match was found.
+    """
+    gbif_matches = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(get_best_gbif_match, session, name): key
+            for key, name in lookup_names.items()
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Checking Species"):
+            gbif_matches[futures[future]] = future.result()
+    return gbif_matches
+
+def check_taxonomy(geopackage_path: str, table_name: str, max_workers: int = MAX_WORKERS):
     """
     Main function to load data, check taxonomy against GBIF, and save discrepancies.
 
     Args:
         geopackage_path: The file path to the input geopackage.
         table_name: The name of the table/layer within the geopackage to process.
+        max_workers: The number of GBIF requests to keep in flight at once.
     """
     # --- 1. Load Data ---
     print(f"Loading data from '{table_name}' in '{geopackage_path}'...")
     try:
-        gdf = gpd.read_file(geopackage_path, layer=table_name)
+        # Only the name columns are used, so geometry is never decoded.
+        gdf = pyogrio.read_dataframe(
+            geopackage_path,
+            layer=table_name,
+            columns=SPECIES_COLUMNS,
+            read_geometry=False
+        )
     except Exception as e:
         print(f"Error: Could not read the table '{table_name}' from the geopackage.")
         print(f"Please ensure the file path is correct and the table exists. Details: {e}")
         return
 
+    # pyogrio silently skips requested columns that don't exist, so check for them.
+    for col in SPECIES_COLUMNS:
+        if col not in gdf.columns:
+            print(f"Error: Column '{col}' not found in '{table_name}'.")
+            return
+
     print(f"Found {len(gdf)} species to check.")
 
     # --- 2. Process Species and Find Discrepancies ---
-    discrepancies = []
-    for index, row in tqdm(gdf.iterrows(), total=gdf.shape[0], desc="Checking Species"):
-        original_sci_name = row.get("scientific_name")
-        original_family = row.get("family")
-        # Get the original common name to persist it in the output.
-        original_common_name = row.get("common_name")
-
-        gbif_match = get_best_gbif_match(original_sci_name)
-
-        if gbif_match:
-            # Use 'canonicalName' for the clean name without author attribution.
-            gbif_sci_name = gbif_match.get("canonicalName")
-            gbif_family = gbif_match.get("family")
-
-            # --- 3. Compare Data and Record Discrepancies ---
-            # Comparisons are case-insensitive and stripped of whitespace for robustness.
-            sci_name_mismatch = (original_sci_name.strip().lower() != gbif_sci_name.strip().lower()
-                                 if original_sci_name and gbif_sci_name else False)
-            family_mismatch = (original_family.strip().lower() != gbif_family.strip().lower()
-                               if original_family and gbif_family else False)
-
-            # Common names are NOT used for comparison, only for output.
-            if sci_name_mismatch or family_mismatch:
-                discrepancies.append({
-                    "original_common_name": original_common_name,
-                    "original_scientific_name": original_sci_name,
-                    "gbif_scientific_name": gbif_sci_name,
-                    "original_family": original_family,
-                    "gbif_family": gbif_family,
-                    "gbif_match_confidence": gbif_match.get("confidence"),
-                    "gbif_match_type": gbif_match.get("matchType")
-                })
+    # Each distinct name is looked up once; names that differ only in case or
+    # surrounding whitespace share a lookup, made with the first spelling seen.
+    name_keys = gdf["scientific_name"].str.strip().str.lower()
+    names = gdf["scientific_name"].dropna().str.strip()
+    # Blank names can never match, so they are not sent to the pool at all.
+    names = names[names != ""]
+    lookup_names = names.groupby(name_keys, sort=False).first()
+    session = create_session(max_workers)
+    gbif_matches = fetch_gbif_matches(session, lookup_names.to_dict(), max_workers)
+
+    # Collect the matches into a frame keyed by lookup key.
+    # Use 'canonicalName' for the clean name without author attribution.
+    gbif_df = pd.DataFrame(
+        [
+            (key, match.get("canonicalName"), match.get("family"), match.get("confidence"), match.get("matchType"))
+            for key, match in gbif_matches.items() if match
+        ],
+        columns=["name_key", "gbif_scientific_name", "gbif_family", "gbif_match_confidence", "gbif_match_type"],
+        dtype=object
+    ).set_index("name_key")
+
+    # --- 3. Compare Data and Record Discrepancies ---
+    # Only species with a GBIF match can be compared.
+    matched = gdf.assign(name_key=name_keys).join(gbif_df, on="name_key", how="inner")
+    # Common names are NOT used for comparison, only for output.
+    sci_name_mismatch = names_differ(matched["scientific_name"], matched["gbif_scientific_name"])
+    family_mismatch = names_differ(matched["family"], matched["gbif_family"])
+    discrepancies_df = matched[sci_name_mismatch | family_mismatch].rename(columns={
+        "common_name": "original_common_name",
+        "scientific_name": "original_scientific_name",
+        "family": "original_family"
+    })
 
     # --- 4. Generate Output ---
-    if discrepancies:
-        print(f"\nFound {len(discrepancies)} discrepancies. Saving to '{OUTPUT_CSV_NAME}'...")
-        discrepancies_df = pd.DataFrame(discrepancies)
+    if not discrepancies_df.empty:
+        print(f"\nFound {len(discrepancies_df)} discrepancies. Saving to '{OUTPUT_CSV_NAME}'...")
         # Reorder columns for clarity in the final CSV
         column_order = [
             "original_common_name", "original_scientific_name", "gbif_scientific_name",
             "original_family", "gbif_family", "gbif_match_confidence", "gbif_match_type"
         ]
         discrepancies_df = discrepancies_df[column_order]
-        discrepancies_df.to_csv(OUTPUT_CSV_NAME, index=False)
+        with open(OUTPUT_CSV_NAME, "w", newline="", buffering=CSV_BUFFER_SIZE) as f:
+            discrepancies_df.to_csv(f, index=False)
         print("Discrepancy report generated successfully.")
     else:
         print("\nNo taxonomic discrepancies found. All entries appear consistent with GBIF.")
 
-
 if __name__ == "__main__":
     # --- Command-Line Argument Parsing ---
     parser = argparse.ArgumentParser(
@@ -164,7 +329,7 @@ if __name__ == "__main__":
             "1. Install uv: pip install uv\n"
             "2. Create a virtual environment: uv venv\n"
             "3. Activate the environment: source .venv/bin/activate\n"
-            "4. Install packages: uv pip install geopandas pandas requests tqdm\n"
+            "4. Install packages: uv pip install orjson pandas pyogrio requests requests-cache tqdm\n"
             "5. Run the script: python your_script_name.py path/to/your/data.gpkg\n"
             "--------------------------"
         ),
@@ -181,10 +346,19 @@ if __name__ == "__main__":
         default="species_master_current",
         help="The name of the table/layer in the geopackage (default: 'species_master_current')."
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=MAX_WORKERS,
+        help=f"The number of concurrent requests made to the GBIF API (default: {MAX_WORKERS})."
+    )
 
     args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error("--workers must be at least 1.")
+
     if not os.path.exists(args.geopackage_path):
         print(f"Error: The file '{args.geopackage_path}' was not found.")
     else:
-        check_taxonomy(args.geopackage_path, args.table)
+        check_taxonomy(args.geopackage_path, args.table, args.workers)